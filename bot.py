@@ -6,14 +6,24 @@ Instagram & YouTube Downloader Bot - With Metadata Error Handling
 import os
 import re
 import sys
+import json
+import sqlite3
 import time
 import random
 import asyncio
 import logging
 import shutil
+import tempfile
+import threading
 import html
+import hashlib
 import traceback
+import contextlib
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
 from datetime import datetime
 
 try:
@@ -24,7 +34,23 @@ except ImportError:
     pass
 
 import instaloader
-from telegram import Update
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+
+try:
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadError
+    YTDLP_AVAILABLE = True
+except ImportError:
+    YoutubeDL = None
+    YTDLP_AVAILABLE = False
+    
+    class DownloadError(Exception):
+        pass
+
+from aiolimiter import AsyncLimiter
+from telegram import Update, InputMediaPhoto, InputMediaVideo
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -33,21 +59,57 @@ from telegram.ext import (
     filters
 )
 from telegram.constants import ParseMode, ChatAction
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 
 # Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 IG_USERNAME = os.getenv("IG_USERNAME", "")
 IG_PASSWORD = os.getenv("IG_PASSWORD", "")
+SESSION_DIR = Path(os.getenv("IG_SESSION_DIR", "."))
+SESSION_MAX_AGE = 7 * 86400  # re-validate sessions unused for a week
+IG_REQUEST_INTERVAL = (8, 14)  # seconds between instaloader requests, across all workers
+IG_MAX_BACKOFF = 1800
+POST_CACHE_TTL = 300
+POST_CACHE_SIZE = 256
+SIDECAR_FETCHES = 4  # carousel items downloaded at once
+IG_WORKERS = max(1, int(os.getenv("IG_WORKERS", "2")))
+YT_WORKERS = max(1, int(os.getenv("YT_WORKERS", "2")))
+FILE_ID_DB = Path(os.getenv("FILE_ID_DB", "file_ids.sqlite3"))
+YT_FRAGMENTS = max(1, int(os.getenv("YT_FRAGS", "4")))
+MAX_CONCURRENT_DOWNLOADS = max(1, int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "8")))
+MAX_DOWNLOADS_PER_USER = max(1, int(os.getenv("MAX_DOWNLOADS_PER_USER", "2")))
+
+# Webhook mode (polling is used when USE_WEBHOOK is unset, e.g. local dev)
+USE_WEBHOOK = os.getenv("USE_WEBHOOK", "").lower() in ("1", "true", "yes")
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
 
 if not BOT_TOKEN:
     print("❌ ERROR: Set BOT_TOKEN in .env file")
     sys.exit(1)
 
+if USE_WEBHOOK and not PUBLIC_URL:
+    print("❌ ERROR: Set PUBLIC_URL in .env file to use webhook mode")
+    sys.exit(1)
+
 print(f"🔑 Token loaded: {BOT_TOKEN[:20]}...")
 
-# Setup
-TEMP_DIR = Path("/tmp/telegram_downloader")
-TEMP_DIR.mkdir(exist_ok=True)
+MIN_FREE_BYTES = 200 * 1024 * 1024
+MAX_FILE_BYTES = 50 * 1024 * 1024  # Telegram bot upload limit
+# /dev/shm must fit the low-space guard plus a few full-size downloads; Docker's
+# default 64MB /dev/shm would refuse every download
+SHM_MIN_FREE_BYTES = MIN_FREE_BYTES + 4 * MAX_FILE_BYTES
+
+# Setup - prefer RAM-backed /dev/shm so downloads never touch the disk
+if os.getenv("TEMPDIR"):
+    TEMP_DIR = Path(os.getenv("TEMPDIR"))
+elif Path("/dev/shm").is_dir() and shutil.disk_usage("/dev/shm").free > SHM_MIN_FREE_BYTES:
+    TEMP_DIR = Path("/dev/shm/telegram_downloader")
+else:
+    TEMP_DIR = Path("/tmp/telegram_downloader")
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -55,12 +117,53 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+MEDIA_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png', 'mp4', 'mov', 'webp'})
+PHOTO_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png'})
+
+def is_rate_limited(e: Exception) -> bool:
+    """Whether an Instagram failure is a 429, judged by type and status code.
+    
+    Not by a bare "429" substring: media errors embed signed CDN URLs, which
+    can contain those digits.
+    """
+    if isinstance(e, instaloader.exceptions.TooManyRequestsException):
+        return True
+    if isinstance(e, HTTPError) and e.response is not None:
+        return e.response.status_code == 429
+    # instaloader's ConnectionException wraps the original "429 Too Many Requests"
+    return "429 too many requests" in str(e).lower()
+
+def report_errors(kind: str):
+    """Turn an unexpected exception in a download coroutine into a logged failure result"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception("❌ %s error", kind)
+                return {"success": False, "error": f"❌ {kind} error: {str(e)[:200]}"}
+        return wrapper
+    return decorator
+
 # ============================================================================
 # INSTAGRAM DOWNLOADER - WITH FALLBACK
 # ============================================================================
 
+# instagram.com/[share/]{p,reel,reels,tv}/<code> and instagr.am/{p,reel,reels,tv}/<code>.
+# Used both to detect Instagram links and to pull the shortcode, so the two always agree
+_IG_URL_RE = re.compile(r'instagr(?:am\.com/(?:share/)?|\.am/)(?:p|reels?|tv)/([A-Za-z0-9_-]+)', re.IGNORECASE)
+
 class InstagramDownloader:
-    def __init__(self):
+    # Pacing and 429 backoff are shared: every worker talks to Instagram from the same IP
+    _pace_lock = asyncio.Lock()
+    _ig_last_request_ts = 0.0
+    _ig_backoff = 0
+    
+    def __init__(self, session_owner: bool = True):
+        # Instaloader isn't thread-safe; DownloaderPool hands this instance to
+        # one download at a time, so self.L never sees concurrent threads
+        # (except _download_sidecar's plain GETs on the separate _cdn_session)
         self.L = instaloader.Instaloader(
             download_pictures=True,
             download_videos=True,
@@ -72,14 +175,30 @@ class InstagramDownloader:
             request_timeout=60
         )
         self.yt_dlp_available = self._check_ytdlp()
-        self._login()
+        # One long-lived YoutubeDL for the fallback; only outtmpl changes per call
+        self._ydl = YoutubeDL({
+            'format': 'best[filesize<50M]/best',
+            'max_filesize': MAX_FILE_BYTES,
+            'noplaylist': True,
+            'quiet': True,
+            'no_warnings': True,
+            # Instagram throttles parallel fragment fetches
+            'concurrent_fragment_downloads': 1,
+            'retries': 3,
+            'fragment_retries': 3,
+            'socket_timeout': 30,
+            'buffersize': 64 * 1024,
+        }) if self.yt_dlp_available else None
+        self._post_cache = {}  # shortcode -> (fetched at, Post), least recently used first
+        self.session_file = SESSION_DIR / f"session_{IG_USERNAME}"
+        if session_owner:
+            self._login()
+        else:
+            self._reuse_session()
+        self._open_cdn_session()
     
     def _check_ytdlp(self):
-        try:
-            import yt_dlp
-            return True
-        except ImportError:
-            return False
+        return YTDLP_AVAILABLE
     
     def _login(self):
         if not IG_USERNAME or not IG_PASSWORD:
@@ -87,12 +206,18 @@ class InstagramDownloader:
             return
         
         try:
-            session_file = Path(f"session_{IG_USERNAME}")
+            session_file = self.session_file
             if session_file.exists():
                 try:
                     self.L.load_session_from_file(IG_USERNAME, str(session_file))
-                    print(f"✅ Loaded session for {IG_USERNAME}")
-                    return
+                    # Recently used sessions are trusted as-is; stale ones get one probe
+                    age = time.time() - session_file.stat().st_mtime
+                    if age <= SESSION_MAX_AGE or self.L.test_login():
+                        self._touch_session()
+                        print(f"✅ Loaded session for {IG_USERNAME}")
+                        return
+                    print("⚠️ Session expired")
+                    session_file.unlink(missing_ok=True)
                 except Exception as e:
                     print(f"⚠️ Session failed: {e}")
             
@@ -103,54 +228,87 @@ class InstagramDownloader:
         except Exception as e:
             print(f"❌ Login failed: {e}")
     
-    def extract_shortcode(self, url: str) -> str:
-        patterns = [
-            r'instagram\.com/p/([A-Za-z0-9_-]+)',
-            r'instagram\.com/reel/([A-Za-z0-9_-]+)',
-            r'instagram\.com/reels/([A-Za-z0-9_-]+)',
-            r'instagram\.com/tv/([A-Za-z0-9_-]+)',
-            r'instagr\.am/p/([A-Za-z0-9_-]+)',
-        ]
-        for p in patterns:
-            m = re.search(p, url)
-            if m:
-                return m.group(1)
-        return None
+    def _reuse_session(self):
+        """Load the session the owning worker already validated - no login round-trip"""
+        if not IG_USERNAME or not self.session_file.exists():
+            return
+        try:
+            self.L.load_session_from_file(IG_USERNAME, str(self.session_file))
+        except Exception as e:
+            print(f"⚠️ Session failed: {e}")
     
-    async def download(self, url: str, download_id: str) -> dict:
-        temp_dir = TEMP_DIR / f"ig_{download_id}"
-        temp_dir.mkdir(exist_ok=True)
+    def _open_cdn_session(self):
+        """Long-lived anonymous session with a keep-alive pool and retries for CDN media.
         
+        Instaloader's own queries can't be pooled: graphql_query / get_iphone_json
+        copy the session per request, and get_raw builds a new anonymous one per
+        file. Carousel fetches (_fetch_media) use this session instead. It must be
+        anonymous like get_raw's, so the logged-in session's www.instagram.com Host
+        header and sessionid cookie never reach the CDN.
+        """
+        adapter = HTTPAdapter(
+            pool_connections=SIDECAR_FETCHES,
+            pool_maxsize=SIDECAR_FETCHES,
+            max_retries=Retry(total=3, backoff_factor=0.5)
+        )
+        self._cdn_session = self.L.context.get_anonymous_session()
+        self._cdn_session.mount("https://", adapter)
+        self._cdn_session.mount("http://", adapter)
+    
+    def _touch_session(self):
+        """Mark the session file as recently working"""
+        try:
+            os.utime(self.session_file)
+        except OSError:
+            pass
+    
+    @staticmethod
+    def extract_shortcode(url: str) -> str:
+        m = _IG_URL_RE.search(url)
+        return m.group(1) if m else None
+    
+    async def download(self, url: str, download_id: str) -> dict:
+        # mkdtemp: one atomic mkdir, unique even for same-second requests
+        temp_dir = Path(tempfile.mkdtemp(prefix=f"ig_{download_id}_", dir=TEMP_DIR))
+        result = await self._download(url, temp_dir)
+        # Failures carry the temp dir too, so the caller can always clean up
+        result.setdefault("temp_dir", str(temp_dir))
+        return result
+    
+    async def _download(self, url: str, temp_dir: Path) -> dict:
         try:
             shortcode = self.extract_shortcode(url)
             if not shortcode:
                 return {"success": False, "error": "Invalid Instagram URL"}
             
-            print(f"📥 Trying instaloader: {shortcode}")
+            logger.info("📥 Trying instaloader: %s", shortcode)
             
             # Try instaloader first
             try:
-                post = instaloader.Post.from_shortcode(self.L.context, shortcode)
-                self.L.dirname_pattern = str(temp_dir)
-                self.L.download_post(post, target=shortcode)
+                await self._pace()
+                fetched = await asyncio.to_thread(self._blocking_download, shortcode, temp_dir)
+                InstagramDownloader._ig_backoff //= 2
                 
-                files = self._collect_files(temp_dir)
-                if files:
+                if fetched["files"]:
                     return {
                         "success": True,
-                        "files": files,
-                        "caption": post.caption[:400] if post.caption else "",
-                        "author": post.owner_username,
-                        "temp_dir": str(temp_dir),
+                        "files": fetched["files"],
+                        "caption_html": fetched["caption_html"],
+                        "author_html": fetched["author_html"],
                         "method": "instaloader"
                     }
             except Exception as e:
                 error_str = str(e).lower()
-                print(f"⚠️ Instaloader failed: {e}")
+                logger.warning("⚠️ Instaloader failed: %s", e)
+                rate_limited = is_rate_limited(e)
+                
+                if rate_limited:
+                    InstagramDownloader._ig_backoff = min(IG_MAX_BACKOFF, InstagramDownloader._ig_backoff * 2 or 60)
+                    logger.warning("🐢 Rate limited - backing off %ss", InstagramDownloader._ig_backoff)
                 
                 # Check if we should try fallback
-                if any(x in error_str for x in ['metadata', '401', '403', '429', 'json', 'query']):
-                    print("🔄 Trying yt-dlp fallback...")
+                if rate_limited or any(x in error_str for x in ['metadata', '401', '403', 'json', 'query']):
+                    logger.info("🔄 Trying yt-dlp fallback...")
                 else:
                     raise  # Don't fallback for other errors
             
@@ -158,7 +316,6 @@ class InstagramDownloader:
             if self.yt_dlp_available:
                 result = await self._download_with_ytdlp(url, temp_dir)
                 if result.get("success"):
-                    result["temp_dir"] = str(temp_dir)
                     result["method"] = "yt-dlp"
                     return result
             
@@ -167,7 +324,7 @@ class InstagramDownloader:
             
         except Exception as e:
             error_str = str(e)
-            print(f"❌ Download error: {e}")
+            logger.error("❌ Download error: %s", e)
             
             # Check for specific errors
             if "metadata" in error_str.lower():
@@ -177,67 +334,142 @@ class InstagramDownloader:
                 return {"success": False, "error": "🔞 Age-restricted content. Cannot download."}
             
             return {"success": False, "error": f"Error: {error_str[:150]}"}
-        finally:
-            # Don't cleanup here - let caller do it
-            pass
+    
+    async def _pace(self):
+        """Space out Instagram requests from all workers with jitter, longer while backing off"""
+        cls = InstagramDownloader
+        # Held while sleeping, so waiting workers take turns instead of firing together
+        async with cls._pace_lock:
+            delta = time.monotonic() - cls._ig_last_request_ts
+            wait = max(random.uniform(*IG_REQUEST_INTERVAL), cls._ig_backoff) - delta
+            if wait > 0:
+                await asyncio.sleep(wait)
+            cls._ig_last_request_ts = time.monotonic()
+    
+    def _get_post(self, shortcode: str):
+        """Post metadata, reused for POST_CACHE_TTL seconds to spare a GraphQL call"""
+        hit = self._post_cache.pop(shortcode, None)
+        if hit and time.monotonic() - hit[0] < POST_CACHE_TTL:
+            fetched_at, post = hit
+        else:
+            fetched_at, post = time.monotonic(), instaloader.Post.from_shortcode(self.L.context, shortcode)
+        # Re-insert so the dict stays ordered by last use
+        self._post_cache[shortcode] = (fetched_at, post)
+        if len(self._post_cache) > POST_CACHE_SIZE:
+            del self._post_cache[next(iter(self._post_cache))]
+        return post
+    
+    def _blocking_download(self, shortcode: str, temp_dir: Path) -> dict:
+        """Fetch and save a post with instaloader (runs in a worker thread)"""
+        post = self._get_post(shortcode)
+        try:
+            if post.typename == "GraphSidecar":
+                self._download_sidecar(post, temp_dir)
+            else:
+                self.L.dirname_pattern = str(temp_dir)
+                self.L.download_post(post, target=shortcode)
+        except Exception:
+            # The cached media URLs may have expired (CDN 403); refetch next time
+            self._post_cache.pop(shortcode, None)
+            raise
+        if IG_USERNAME:
+            self._touch_session()
+        
+        # Read each lazy property once; a missing caption/owner isn't worth failing over
+        try:
+            caption = (post.caption or "")[:400]
+        except Exception:
+            caption = ""
+        try:
+            author = post.owner_username or "unknown"
+        except Exception:
+            author = "unknown"
+        
+        return {
+            "files": self._collect_files(temp_dir),
+            # Escaped here, off the event loop, so the handler only concatenates
+            "caption_html": html.escape(caption),
+            "author_html": html.escape(author)
+        }
+    
+    def _download_sidecar(self, post, temp_dir: Path):
+        """Fetch carousel items in parallel instead of one after another.
+        
+        Replaces download_post for sidecars: its download_pic opens a fresh
+        anonymous session (new TCP/TLS connection) per item. These GETs share the
+        worker's long-lived anonymous _cdn_session and its keep-alive pool instead.
+        Files are named <shortcode>_<n>.<ext> (download_post would use
+        {date_utc}_UTC_<n>); the temp dir is always new, so there are no existing
+        files to skip.
+        """
+        jobs = [
+            ((node.is_video and node.video_url) or node.display_url, str(temp_dir / f"{post.shortcode}_{i}"))
+            for i, node in enumerate(post.get_sidecar_nodes(), start=1)
+        ]
+        with ThreadPoolExecutor(max_workers=SIDECAR_FETCHES) as pool:
+            # list() re-raises the first failed fetch, like download_post would
+            list(pool.map(lambda job: self._fetch_media(*job), jobs))
+    
+    def _fetch_media(self, url: str, filename: str):
+        """GET one CDN URL over the anonymous pooled session and save it; HTTP errors raise"""
+        context = self.L.context
+        with self._cdn_session.get(url, stream=True) as resp:
+            resp.raise_for_status()
+            # Extension from Content-Type, as download_pic does (jpeg -> jpg)
+            mime = resp.headers.get('Content-Type', '').split(';')[0]
+            ext = mime.rpartition('/')[2].lower().replace('jpeg', 'jpg') or Path(urlsplit(url).path).suffix[1:]
+            resp.raw.decode_content = True
+            context.write_raw(resp, f"{filename}.{ext}")
     
     def _collect_files(self, temp_dir: Path) -> list:
-        """Collect media files from directory"""
+        """Collect (path, "photo" | "video") media files from directory"""
         files = []
-        for f in temp_dir.iterdir():
-            if f.suffix.lower() in ['.jpg', '.jpeg', '.png', '.mp4', '.mov', '.webp']:
-                size_mb = f.stat().st_size / (1024 * 1024)
-                if size_mb <= 50:
-                    files.append(str(f))
-                    print(f"  ✓ {f.name} ({size_mb:.1f}MB)")
+        with os.scandir(temp_dir) as it:
+            for e in it:
+                ext = e.name.rpartition('.')[2].lower()
+                if ext in MEDIA_EXTENSIONS:
+                    size = e.stat().st_size
+                    if size <= MAX_FILE_BYTES:
+                        files.append((e.path, "photo" if ext in PHOTO_EXTENSIONS else "video"))
+                        logger.info("  ✓ %s (%.1fMB)", e.name, size / (1024 * 1024))
+        # scandir order is arbitrary; "<name>_<n>" carousel items sort by n (so _10 follows _9)
+        files.sort(key=lambda f: [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', os.path.basename(f[0]))])
         return files
     
     async def _download_with_ytdlp(self, url: str, temp_dir: Path) -> dict:
         """Fallback using yt-dlp"""
         try:
-            from yt_dlp import YoutubeDL
-            
             output_path = str(temp_dir / "inst_%(title)s.%(ext)s")
             
-            ydl_opts = {
-                'format': 'best[filesize<50M]/best',
-                'outtmpl': output_path,
-                'max_filesize': 50 * 1024 * 1024,
-                'noplaylist': True,
-                'quiet': True,
-                'no_warnings': True,
-            }
-            
-            print(f"📥 yt-dlp downloading: {url}")
+            logger.info("📥 yt-dlp downloading: %s", url)
             
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
+            def run():
+                self._ydl.params['outtmpl'] = {'default': output_path}
+                info = self._ydl.extract_info(url, download=True)
                 title = info.get('title', 'Instagram Post')
                 uploader = info.get('uploader', 'unknown')
+                return {
+                    "files": self._collect_files(temp_dir),
+                    "caption_html": html.escape(title[:400] if title else ""),
+                    "author_html": html.escape(uploader if uploader else "unknown")
+                }
             
-            files = self._collect_files(temp_dir)
+            fetched = await asyncio.to_thread(run)
             
-            if not files:
+            if not fetched["files"]:
                 return {"success": False, "error": "No files downloaded"}
             
-            return {
-                "success": True,
-                "files": files,
-                "caption": title[:400] if title else "",
-                "author": uploader if uploader else "unknown"
-            }
+            return {"success": True, **fetched}
             
         except Exception as e:
             error_str = str(e)
-            print(f"❌ yt-dlp failed: {e}")
+            logger.error("❌ yt-dlp failed: %s", e)
             
             if any(x in error_str.lower() for x in ['inappropriate', 'age', 'restricted', 'login', 'private']):
                 return {"success": False, "error": "Content restricted or requires login"}
             
             return {"success": False, "error": f"yt-dlp error: {error_str[:100]}"}
 
-ig_downloader = InstagramDownloader()
-
 # ============================================================================
 # YOUTUBE DOWNLOADER
 # ============================================================================
@@ -245,71 +477,216 @@ ig_downloader = InstagramDownloader()
 class YouTubeDownloader:
     def __init__(self):
         self.available = self._check()
+        # One long-lived YoutubeDL per worker; only outtmpl changes per call.
+        # Its in-memory cookie jar is per worker too, so nothing is shared or written to disk
+        self._ydl = YoutubeDL({
+            # Progressive H.264 mp4 first: no ffmpeg merge, and it plays inline in every Telegram client.
+            # Then anything known (or estimated) to fit under 50MB, an mp4+m4a split pair whose parts
+            # fit together (so the merge stays a playable mp4, not webm/mkv), and when sizes are unknown a 480p cap rather than a video max_filesize rejects
+            'format': (
+                'best[ext=mp4][vcodec^=avc1][filesize<50M]'
+                '/best[filesize<50M]'
+                '/best[filesize_approx<50M]'
+                '/bestvideo[ext=mp4][height<=720][filesize<45M]+bestaudio[ext=m4a][filesize<5M]'
+                '/best[height<=480]'
+                '/best'
+            ),
+            'merge_output_format': 'mp4',
+            'max_filesize': MAX_FILE_BYTES,
+            'noplaylist': True,
+            'concurrent_fragment_downloads': YT_FRAGMENTS,
+            'http_chunk_size': 10 * 1024 * 1024,
+            'retries': 3,
+            'fragment_retries': 3,
+            'socket_timeout': 30,
+            'buffersize': 64 * 1024,
+        }) if self.available else None
     
     def _check(self) -> bool:
-        try:
-            import yt_dlp
-            return True
-        except ImportError:
-            return False
+        return YTDLP_AVAILABLE
     
     async def download(self, url: str, download_id: str) -> dict:
         if not self.available:
             return {"success": False, "error": "Run: pip install yt-dlp"}
         
-        temp_dir = TEMP_DIR / f"yt_{download_id}"
-        temp_dir.mkdir(exist_ok=True)
-        
+        temp_dir = Path(tempfile.mkdtemp(prefix=f"yt_{download_id}_", dir=TEMP_DIR))
+        result = await self._download(url, temp_dir)
+        result.setdefault("temp_dir", str(temp_dir))
+        return result
+    
+    @report_errors("YouTube")
+    async def _download(self, url: str, temp_dir: Path) -> dict:
         try:
-            from yt_dlp import YoutubeDL
-            
             output_path = str(temp_dir / "%(title)s.%(ext)s")
             
-            ydl_opts = {
-                'format': 'best[filesize<50M]/bestvideo[filesize<50M]+bestaudio/best',
-                'outtmpl': output_path,
-                'max_filesize': 50 * 1024 * 1024,
-                'noplaylist': True,
-            }
-            
-            print(f"📥 YouTube: {url}")
+            logger.info("📥 YouTube: %s", url)
             
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                title = info.get('title', 'video')
+            def run():
+                self._ydl.params['outtmpl'] = {'default': output_path}
+                info = self._ydl.extract_info(url, download=True)
+                best, best_size = None, -1
+                with os.scandir(temp_dir) as it:
+                    for e in it:
+                        if not e.is_file(follow_symlinks=False):
+                            continue
+                        size = e.stat(follow_symlinks=False).st_size
+                        if size > best_size:
+                            best, best_size = e, size
+                return info, best, best_size
             
-            files = list(temp_dir.iterdir())
-            if not files:
+            info, video_file, size = await asyncio.to_thread(run)
+            title = info.get('title', 'video')
+            if not video_file:
+                # max_filesize makes yt-dlp skip oversized videos instead of raising
+                expected = info.get('filesize') or info.get('filesize_approx') or 0
+                if expected > MAX_FILE_BYTES:
+                    return {"success": False, "error": "❌ Video is larger than 50MB - Telegram won't accept it."}
                 return {"success": False, "error": "No file created"}
+            if size > MAX_FILE_BYTES:
+                # max_filesize can't stop fragmented/DASH downloads whose size isn't known up front
+                return {"success": False, "error": "❌ Video is larger than 50MB - Telegram won't accept it."}
             
-            video_file = max(files, key=lambda x: x.stat().st_size)
-            size_mb = video_file.stat().st_size / (1024 * 1024)
+            size_mb = size / (1024 * 1024)
             
-            print(f"  ✓ {video_file.name} ({size_mb:.1f}MB)")
+            logger.info("  ✓ %s (%.1fMB)", video_file.name, size_mb)
             
             return {
                 "success": True,
-                "file": str(video_file),
+                "file": video_file.path,
+                "files": [(video_file.path, "video")],
                 "title": title,
                 "size_mb": round(size_mb, 2),
-                "temp_dir": str(temp_dir)
+                # Sent along with the video so Telegram can skip probing it
+                "width": info.get('width'),
+                "height": info.get('height'),
+                "duration": int(info['duration']) if info.get('duration') else None
             }
             
-        except Exception as e:
-            print(f"❌ YouTube error: {e}")
-            return {"success": False, "error": str(e)}
+        except DownloadError as e:
+            # yt-dlp messages look like "ERROR: [youtube] <id>: <reason>"
+            reason = re.sub(r'^ERROR:\s*(\[[^\]]+\]\s*[^:]*:\s*)?', '', e.msg or str(e))
+            logger.error("❌ YouTube error: %s", e)
+            return {"success": False, "error": f"❌ {reason[:200]}"}
+
+# ============================================================================
+# DOWNLOADER POOLS
+# ============================================================================
+
+class DownloaderPool:
+    """Runs up to len(workers) downloads in parallel, one per idle worker.
+    
+    The pool size is the per-platform concurrency cap (IG_WORKERS / YT_WORKERS);
+    slots is the global cap shared by all pools.
+    """
+    
+    def __init__(self, workers: list, slots: asyncio.Semaphore):
+        self.workers = workers
+        self._slots = slots
+        self._idle = asyncio.Queue()
+        for w in workers:
+            self._idle.put_nowait(w)
+    
+    @property
+    def busy(self) -> bool:
+        """True when a new download would wait: every worker or every global slot is taken"""
+        return self._idle.empty() or self._slots.locked()
+    
+    @report_errors("Download")
+    async def download(self, url: str, download_id: str, on_start=None) -> dict:
+        """Wait for an idle worker, then a global slot; await on_start() once both are ours"""
+        worker = await self._idle.get()
+        try:
+            # Worker first: requests queued behind a busy platform don't sit on
+            # global slots the other platform could use
+            async with self._slots:
+                if on_start:
+                    await on_start()
+                return await worker.download(url, download_id)
+        finally:
+            self._idle.put_nowait(worker)
+
+# Total downloads in flight, across both platforms
+download_sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Only the first worker logs in / validates; the rest share its session file
+ig_downloader = DownloaderPool([InstagramDownloader(session_owner=(i == 0)) for i in range(IG_WORKERS)], download_sem)
+yt_downloader = DownloaderPool([YouTubeDownloader() for _ in range(YT_WORKERS)], download_sem)
 
-yt_downloader = YouTubeDownloader()
+# ============================================================================
+# FILE_ID CACHE
+# ============================================================================
+
+class FileIdCache:
+    """Remembers Telegram file_ids of sent posts so repeats need no download or upload.
+    
+    Writes are committed in batches by run_flusher() (and flush() on shutdown)
+    to a write-ahead log, rather than fsyncing the database on every change.
+    """
+    
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        # Commits append to the WAL instead of rewriting pages; NORMAL only fsyncs at checkpoints
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, items TEXT NOT NULL)"
+        )
+        self.db.commit()
+        self._dirty = False
+        # Guards _dirty against a commit running in a to_thread flush (a cancelled run_flusher
+        # can leave one behind; the final flush waits for it). The connection serializes anyway
+        self._flush_lock = threading.Lock()
+    
+    def get(self, key: str):
+        """Return (caption, [(file_id, kind), ...]) or None"""
+        row = self.db.execute("SELECT caption, items FROM media WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        return row[0], [tuple(item) for item in json.loads(row[1])]
+    
+    def put(self, key: str, caption: str, items: list):
+        with self._flush_lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO media (key, caption, items) VALUES (?, ?, ?)",
+                (key, caption, json.dumps(items))
+            )
+            self._dirty = True
+    
+    def delete(self, key: str):
+        with self._flush_lock:
+            self.db.execute("DELETE FROM media WHERE key = ?", (key,))
+            self._dirty = True
+    
+    def flush(self):
+        with self._flush_lock:
+            if self._dirty:
+                # Only clear after a successful commit, so a failed one is retried next round
+                self.db.commit()
+                self._dirty = False
+    
+    async def run_flusher(self, interval: float = 5):
+        while True:
+            await asyncio.sleep(interval)
+            if self._dirty:
+                try:
+                    await asyncio.to_thread(self.flush)
+                except Exception as e:
+                    logger.error("❌ file_id cache flush failed: %s", e)
+
+file_id_cache = FileIdCache(FILE_ID_DB)
 
 # ============================================================================
 # BOT
 # ============================================================================
 
+# Only links to actual media count - a bare profile or homepage link is ignored
+# (Instagram uses _IG_URL_RE from the downloader section)
+_YT_URL_RE = re.compile(r'(?:youtube\.com/(?:watch|shorts/|live/)|youtu\.be/)', re.IGNORECASE)
+
 def detect_platform(url: str) -> str:
-    url_lower = url.lower()
-    if any(x in url_lower for x in ['instagram.com', 'instagr.am']):
+    if _IG_URL_RE.search(url):
         return "instagram"
-    if any(x in url_lower for x in ['youtube.com', 'youtu.be']):
+    if _YT_URL_RE.search(url):
         return "youtube"
     return None
 
@@ -332,6 +709,180 @@ Hello {user.first_name}!
 Send me a link!
 """, parse_mode=ParseMode.MARKDOWN)
 
+# Telegram caps bots at ~30 messages/sec; only block when we actually get close
+send_limiter = AsyncLimiter(25, 1)
+SEND_RETRIES = 3
+# PTB caps writes of requests with files at 20s unless write_timeout is passed
+# explicitly; a 50MB video or a full album on a slow uplink needs far longer
+UPLOAD_WRITE_TIMEOUT = 300
+STREAMING_MIN_BYTES = 10 * 1024 * 1024
+
+# Fairness: one user can't flood the pools (the global cap lives with the pools)
+_user_slots = {}  # user id -> [semaphore, holders + waiters]
+_background_tasks = set()  # strong refs so pending tasks aren't garbage collected
+_download_counter = itertools.count()  # unique per process, unlike a timestamp
+
+def _take_bytes(path: str) -> bytes:
+    """Read a staged file for upload and delete it right away.
+    
+    PTB holds the whole upload in memory anyway, and on tmpfs the file is RAM
+    too; dropping it once read keeps each file in memory only once.
+    """
+    data = Path(path).read_bytes()
+    os.unlink(path)
+    return data
+
+def _streamable(data) -> bool:
+    """Worth a streaming player: uploaded bytes over STREAMING_MIN_BYTES (file_ids never are)"""
+    return isinstance(data, bytes) and len(data) > STREAMING_MIN_BYTES
+
+def _cleanup(files: list, temp_dir: str):
+    """Delete the known download files, then their directory"""
+    for p, _ in files:
+        try:
+            os.unlink(p)
+        except FileNotFoundError:
+            pass
+        except IsADirectoryError:
+            shutil.rmtree(p, ignore_errors=True)
+        except OSError as e:
+            logger.error("Cleanup error: %s", e)
+    try:
+        os.rmdir(temp_dir)
+    except OSError:
+        # Leftovers we didn't track (partial downloads etc.)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+@contextlib.asynccontextmanager
+async def user_slot(user_id: int):
+    """Cap how many downloads a single user can have in flight"""
+    entry = _user_slots.setdefault(user_id, [asyncio.Semaphore(MAX_DOWNLOADS_PER_USER), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        # Drop the entry once nobody holds or waits on it, so the dict stays small
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_slots[user_id]
+
+async def cleanup_download(result: dict):
+    """Remove a download's temp files without blocking the event loop"""
+    temp_dir = result.get("temp_dir")
+    if temp_dir:
+        await asyncio.to_thread(_cleanup, result.get("files", []), temp_dir)
+
+def cleanup_in_background(result: dict):
+    """Fire-and-forget cleanup_download so replies don't wait on unlinks"""
+    task = asyncio.create_task(cleanup_download(result))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+@contextlib.asynccontextmanager
+async def temp_files():
+    """Yield a track(result) function; tracked downloads are cleaned up on exit, whatever the outcome"""
+    results = []
+    
+    def track(result: dict) -> dict:
+        results.append(result)
+        return result
+    
+    try:
+        yield track
+    finally:
+        for result in results:
+            cleanup_in_background(result)
+
+async def send_with_retry(send, *args, **kwargs):
+    """Rate-limited media send that waits out Telegram's flood control instead of failing"""
+    kwargs.setdefault("write_timeout", UPLOAD_WRITE_TIMEOUT)
+    for attempt in range(SEND_RETRIES):
+        try:
+            async with send_limiter:
+                return await send(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == SEND_RETRIES - 1:
+                raise
+            logger.warning("⏳ Flood control, retrying in %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+def _sent_file_id(message):
+    """(file_id, kind) of the media in a message we just sent"""
+    if message.photo:
+        return message.photo[-1].file_id, "photo"
+    if message.video:
+        return message.video.file_id, "video"
+    return None
+
+async def send_media(update: Update, context: ContextTypes.DEFAULT_TYPE, files: list, caption: str, cached: bool = False) -> list:
+    """Send files as albums of up to 10, falling back to one message per file.
+    
+    files are (path, kind) pairs, or (file_id, kind) pairs when cached is True.
+    The caption goes on the first file. Returns (file_id, kind) for every file
+    that was sent.
+    """
+    async def media_for(f):
+        # PTB reads local files synchronously while building the request, so
+        # load them in a thread and hand over the bytes
+        return f if cached else await asyncio.to_thread(_take_bytes, f)
+    
+    def filename(f):
+        return None if cached else os.path.basename(f)
+    
+    def caption_kwargs(text):
+        return {"caption": text, "parse_mode": ParseMode.HTML} if text else {}
+    
+    async def send_album(chunk, album_caption):
+        media = []
+        for i, (f, data, kind) in enumerate(chunk):
+            extra = caption_kwargs(album_caption if i == 0 else None)
+            if kind == "photo":
+                media.append(InputMediaPhoto(media=data, filename=filename(f), **extra))
+            else:
+                media.append(InputMediaVideo(media=data, filename=filename(f), supports_streaming=_streamable(data), **extra))
+        messages = await send_with_retry(context.bot.send_media_group, chat_id=update.effective_chat.id, media=media)
+        return [fid for fid in map(_sent_file_id, messages) if fid]
+    
+    async def send_single(f, data, kind, single_caption):
+        extra = caption_kwargs(single_caption)
+        if kind == "photo":
+            message = await send_with_retry(update.message.reply_photo, photo=data, filename=filename(f), **extra)
+        else:
+            message = await send_with_retry(update.message.reply_video, video=data, filename=filename(f), supports_streaming=_streamable(data), **extra)
+        return _sent_file_id(message)
+    
+    sent = []
+    for start in range(0, len(files), 10):
+        # Load each file once; the per-file fallback reuses the same bytes
+        chunk = [(f, await media_for(f), kind) for f, kind in files[start:start + 10]]
+        chunk_caption = caption if start == 0 else None
+        
+        if len(chunk) > 1:
+            try:
+                sent += await send_album(chunk, chunk_caption)
+                continue
+            except Exception as e:
+                logger.warning("⚠️ Album send failed, sending files one by one: %s", e)
+        
+        # One at a time to keep the post's order; one failed file shouldn't stop the rest
+        for i, (f, data, kind) in enumerate(chunk):
+            try:
+                r = await send_single(f, data, kind, chunk_caption if i == 0 else None)
+            except Exception as e:
+                logger.error("Send error: %s", e)
+                continue
+            if r:
+                sent.append(r)
+    return sent
+
+def media_cache_key(platform: str, url: str) -> str:
+    """file_id cache key: the shortcode for Instagram, a URL hash for YouTube"""
+    if platform == "instagram":
+        shortcode = InstagramDownloader.extract_shortcode(url)
+        return f"instagram:{shortcode}" if shortcode else None
+    return "youtube:" + hashlib.sha1(url.encode()).hexdigest()[:16]
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
         return
@@ -343,89 +894,166 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not platform:
         return
     
-    download_id = f"{user.id}_{int(time.time())}"
+    # Media we've sent before can be re-sent by file_id without downloading again
+    cache_key = media_cache_key(platform, url)
+    if cache_key:
+        cached = file_id_cache.get(cache_key)
+        if cached:
+            caption, items = cached
+            try:
+                sent = await send_media(update, context, items, caption, cached=True)
+            except Exception as e:
+                logger.warning("⚠️ Cached send failed: %s", e)
+                sent = []
+            if sent:
+                return
+            file_id_cache.delete(cache_key)
     
-    msg = await update.message.reply_text(f"⏳ Downloading from {platform}...")
+    if (await asyncio.to_thread(shutil.disk_usage, TEMP_DIR)).free < MIN_FREE_BYTES:
+        await update.message.reply_text("⚠️ Server is busy (low temp space). Please try again in a few minutes.")
+        return
     
-    try:
-        if platform == "instagram":
-            result = await ig_downloader.download(url, download_id)
-        else:
-            result = await yt_downloader.download(url, download_id)
-        
-        if not result.get("success"):
-            await msg.edit_text(result.get("error", "Failed"), parse_mode=ParseMode.MARKDOWN)
-            # Cleanup on failure
-            temp_dir = result.get("temp_dir")
-            if temp_dir:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            return
+    download_id = f"{user.id}_{next(_download_counter):x}"
+    
+    pool = ig_downloader if platform == "instagram" else yt_downloader
+    
+    async with user_slot(user.id), temp_files() as track:
+        # Queued behind this platform's busy workers or the global cap
+        queued = pool.busy
+        msg = await update.message.reply_text(
+            "⏳ You're in queue, your download starts shortly..." if queued else f"⏳ Downloading from {platform}..."
+        )
         
-        await msg.edit_text("📤 Sending...")
+        async def started():
+            if queued:
+                await msg.edit_text(f"⏳ Downloading from {platform}...")
         
-        if platform == "instagram":
-            files = result.get("files", [])
-            caption = html.escape(result.get('caption', '')[:400])
-            author = html.escape(result.get('author', 'unknown'))
-            method = result.get('method', 'unknown')
-            
-            await update.message.reply_text(
-                f"📸 <b>Instagram Post</b> ({method})\n👤 @{author}\n\n{caption if caption else '<i>No caption</i>'}",
-                parse_mode=ParseMode.HTML
-            )
-            
-            sent = 0
-            for f in files[:10]:
-                try:
-                    with open(f, 'rb') as file:
-                        if f.lower().endswith(('.jpg', '.jpeg', '.png')):
-                            await update.message.reply_photo(photo=file)
-                        else:
-                            await update.message.reply_video(video=file)
-                    sent += 1
-                    await asyncio.sleep(0.5)
-                except Exception as e:
-                    print(f"Send error: {e}")
+        try:
+            result = track(await pool.download(url, download_id, on_start=started))
             
-            # Cleanup
-            temp_dir = result.get("temp_dir")
-            if temp_dir:
-                shutil.rmtree(temp_dir, ignore_errors=True)
+            if not result.get("success"):
+                await msg.edit_text(result.get("error", "Failed"))
+                return
             
-            await msg.edit_text(f"✅ {sent} files sent")
+            await msg.edit_text("📤 Sending...")
             
-        else:  # YouTube
-            with open(result.get("file"), 'rb') as f:
-                await update.message.reply_video(
-                    video=f,
-                    caption=f"🎬 {result.get('title')}\n📦 {result.get('size_mb')}MB"
+            if platform == "instagram":
+                files = result.get("files", [])
+                caption = result.get('caption_html', '')
+                author = result.get('author_html', 'unknown')
+                method = result.get('method', 'unknown')
+                
+                post_caption = f"📸 <b>Instagram Post</b> ({method})\n👤 @{author}\n\n{caption if caption else '<i>No caption</i>'}"
+                sent = await send_media(update, context, files, post_caption)
+                if cache_key and len(sent) == len(files):
+                    file_id_cache.put(cache_key, post_caption, sent)
+                
+                await msg.edit_text(f"✅ {len(sent)} files sent")
+                
+            else:  # YouTube
+                video_path = result.get("file")
+                video_caption = f"🎬 {result.get('title')}\n📦 {result.get('size_mb')}MB"
+                video_data = await asyncio.to_thread(_take_bytes, video_path)
+                message = await send_with_retry(
+                    update.message.reply_video,
+                    video=video_data,
+                    filename=os.path.basename(video_path),
+                    caption=video_caption,
+                    width=result.get("width"),
+                    height=result.get("height"),
+                    duration=result.get("duration"),
+                    supports_streaming=_streamable(video_data)
                 )
-            shutil.rmtree(result.get("temp_dir"), ignore_errors=True)
-            await msg.edit_text("✅ Done!")
-            
-    except Exception as e:
-        print(f"Error: {e}")
-        await msg.edit_text(f"❌ Error: {str(e)[:200]}")
+                sent = _sent_file_id(message)
+                if sent:
+                    # Cached captions are replayed as HTML
+                    file_id_cache.put(cache_key, html.escape(video_caption), [sent])
+                await msg.edit_text("✅ Done!")
+                
+        except Exception as e:
+            logger.error("Error: %s", e)
+            await msg.edit_text(f"❌ Error: {str(e)[:200]}")
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(f"Error: {context.error}")
+    logger.error("Error: %s", context.error)
+
+def _sweep_stale_temp_dirs(max_age: float = 3600) -> int:
+    """Remove download dirs left behind by a crash or hard restart"""
+    cutoff = time.time() - max_age
+    removed = 0
+    with os.scandir(TEMP_DIR) as it:
+        for entry in it:
+            if (entry.name.startswith(("ig_", "yt_"))
+                    and entry.is_dir(follow_symlinks=False)
+                    and entry.stat(follow_symlinks=False).st_mtime < cutoff):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    return removed
+
+async def post_init(application: Application):
+    removed = await asyncio.to_thread(_sweep_stale_temp_dirs)
+    if removed:
+        logger.info("🧹 Removed %d stale temp dirs", removed)
+    # Not application.create_task: PTB doesn't track tasks created before the app is running
+    application.bot_data["flusher"] = asyncio.create_task(file_id_cache.run_flusher())
+
+async def post_shutdown(application: Application):
+    flusher = application.bot_data.pop("flusher", None)
+    if flusher:
+        flusher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await flusher
+    file_id_cache.flush()
 
 def main():
     print("\n" + "="*60)
     print("🚀 BOT STARTING")
     print("="*60)
     print(f"📸 Instagram: {'✅' if IG_USERNAME else '⚠️ Anonymous'}")
-    print(f"🎬 YouTube: {'✅' if yt_downloader.available else '❌'}")
-    print(f"🔧 Fallback: {'✅ yt-dlp' if ig_downloader.yt_dlp_available else '❌'}")
+    print(f"🎬 YouTube: {'✅' if yt_downloader.workers[0].available else '❌'}")
+    print(f"🔧 Fallback: {'✅ yt-dlp' if ig_downloader.workers[0].yt_dlp_available else '❌'}")
+    print(f"📂 Temp dir: {TEMP_DIR}")
+    print(f"👷 Workers: {IG_WORKERS} Instagram / {YT_WORKERS} YouTube")
     print("="*60 + "\n")
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    # Handle updates concurrently and give uploads a pool of HTTP/2 connections
+    # instead of queueing every API call behind the previous one. getUpdates
+    # gets its own small client so long polls never hold an upload slot.
+    api_request = HTTPXRequest(
+        connection_pool_size=64,
+        pool_timeout=30,
+        read_timeout=60,
+        write_timeout=UPLOAD_WRITE_TIMEOUT,
+        http_version="2"
+    )
+    updates_request = HTTPXRequest(connection_pool_size=2, read_timeout=60, http_version="2")
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .request(api_request)
+        .get_updates_request(updates_request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_error_handler(error_handler)
     
-    print("🤖 Running!\n")
-    app.run_polling(drop_pending_updates=True)
+    if USE_WEBHOOK:
+        print(f"🤖 Running (webhook on port {WEBHOOK_PORT})!\n")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{PUBLIC_URL}/{BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True
+        )
+    else:
+        print("🤖 Running (polling)!\n")
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file